@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""
+Hammer redir.py with keep-alive connections, reports requests/sec.
+
+    loadtest.py http://127.0.0.1:8080/ --connections 32 --requests 500
+"""
+import argparse
+import http.client
+import threading
+import time
+from urllib.parse import urlsplit
+
+
+def worker(url, requests, latencies):
+    parts = urlsplit(url)
+    path = parts.path or '/'
+    conn = http.client.HTTPConnection(parts.hostname, parts.port or 80)
+    for _ in range(requests):
+        start = time.perf_counter()
+        conn.request('GET', path)
+        conn.getresponse().read()
+        latencies.append(time.perf_counter() - start)
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('url')
+    parser.add_argument('--connections', type=int, default=32)
+    parser.add_argument('--requests', type=int, default=500,
+                        help='Requests per connection.')
+    args = parser.parse_args()
+
+    latencies = []
+    threads = [
+        threading.Thread(target=worker,
+                         args=(args.url, args.requests, latencies))
+        for _ in range(args.connections)
+    ]
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    print('{} requests in {:.2f}s, {:.0f} requests/sec'.format(
+        len(latencies), elapsed, len(latencies) / elapsed
+    ))
+    print('p50 {:.2f}ms p99 {:.2f}ms'.format(
+        latencies[len(latencies) // 2] * 1e3,
+        latencies[int(len(latencies) * 0.99)] * 1e3
+    ))
+
+
+if __name__ == "__main__":
+    main()
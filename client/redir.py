@@ -1,18 +1,186 @@
 #!/usr/bin/env python3
+"""
+Redirect / payload server for link previews.
 
-import sys
-from http.server import HTTPServer, BaseHTTPRequestHandler
+Threaded, with HTTP/1.1 keep-alive, so a burst of preview fetches from every
+session that got an injected <url> doesn't get serialized. Paths can be routed
+to redirects or to static payload files (sent with sendfile), anything else
+gets the default redirect if one was given.
+
+    redir.py 8080 https://example.com/
+    redir.py 8080 --route /a=https://example.com/ --file /b.png=payload.png
+"""
+import argparse
+import json
+import mimetypes
+import os
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class RequestLog:
+    """
+    JSON lines request log, buffered and written from a background thread.
+    """
+
+    def __init__(self, path, interval=1.0):
+        self._f = open(path, 'a') if path else None
+        self._lock = threading.Lock()
+        self._pending = []
+        self._interval = interval
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def add(self, entry):
+        if self._f is None:
+            return
+        line = json.dumps(entry, separators=(',', ':'))
+        with self._lock:
+            self._pending.append(line)
+
+    def flush(self):
+        if self._f is None:
+            return
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if pending:
+            self._f.write('\n'.join(pending) + '\n')
+            self._f.flush()
+
+    def _run(self):
+        while True:
+            time.sleep(self._interval)
+            self.flush()
 
-if len(sys.argv)-1 != 2:
-    print("""
-Usage: {} <port_number> <url>
-    """.format(sys.argv[0]))
-    sys.exit()
 
 class Redirect(BaseHTTPRequestHandler):
-   def do_GET(self):
-       self.send_response(302)
-       self.send_header('Location', sys.argv[2])
-       self.end_headers()
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self._handle(send_body=True)
+
+    def do_HEAD(self):
+        self._handle(send_body=False)
+
+    def _handle(self, send_body):
+        start = time.perf_counter()
+        path = self.path.split('?', 1)[0]
+        routes = self.server.routes
+
+        if path in routes.files:
+            status, sent = self._send_file(routes.files[path], send_body)
+        elif path in routes.redirects or routes.default:
+            status, sent = self._redirect(
+                routes.redirects.get(path, routes.default)
+            )
+        else:
+            status, sent = self._empty(404)
+
+        self.server.request_log.add({
+            'time': time.time(),
+            'client': self.client_address[0],
+            'method': self.command,
+            'path': self.path,
+            'status': status,
+            'bytes': sent,
+            'duration': time.perf_counter() - start,
+            'user_agent': self.headers.get('User-Agent'),
+        })
+
+    def _empty(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        return status, 0
+
+    def _redirect(self, location):
+        self.send_response(302)
+        self.send_header('Location', location)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        return 302, 0
+
+    def _send_file(self, path, send_body):
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            return self._empty(404)
+
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            content_type, _ = mimetypes.guess_type(path)
+
+            self.send_response(200)
+            self.send_header(
+                'Content-Type', content_type or 'application/octet-stream'
+            )
+            self.send_header('Content-Length', str(size))
+            self.end_headers()
+            if not send_body:
+                return 200, 0
+
+            self.wfile.flush()
+            offset = 0
+            while offset < size:
+                sent = os.sendfile(
+                    self.connection.fileno(), f.fileno(), offset, size - offset
+                )
+                if sent == 0:
+                    break
+                offset += sent
+
+        return 200, offset
+
+    def log_message(self, format, *args):
+        # Everything goes to the request log instead.
+        pass
+
+
+class Routes:
+    def __init__(self, default=None, redirects=None, files=None):
+        self.default = default
+        self.redirects = redirects or {}
+        self.files = files or {}
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+def mapping(value):
+    path, _, target = value.partition('=')
+    if not path.startswith('/') or not target:
+        raise argparse.ArgumentTypeError(f'expected /path=target: {value}')
+    return path, target
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('port', type=int)
+    parser.add_argument('url', nargs='?', default=None,
+                        help='Redirect for paths without a route.')
+    parser.add_argument('--listen-address', default='')
+    parser.add_argument('--route', action='append', default=[], type=mapping,
+                        help='/path=url, redirect path to url.')
+    parser.add_argument('--file', action='append', default=[], type=mapping,
+                        help='/path=file, serve file at path.')
+    parser.add_argument('--log', default='requests.jsonl',
+                        help='Request log, empty to disable.')
+    args = parser.parse_args()
+
+    server = Server((args.listen_address, args.port), Redirect)
+    server.routes = Routes(args.url, dict(args.route), dict(args.file))
+    server.request_log = RequestLog(args.log)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.request_log.flush()
+
 
-HTTPServer(("", int(sys.argv[1])), Redirect).serve_forever()
+if __name__ == "__main__":
+    main()
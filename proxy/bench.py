@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Micro benchmarks for the proxy internals.
+"""
+import os
+import re
+import tempfile
+import time
+import zlib
+
+import click
+
+from hookloader import HookLoader, compile_hooks
+from compression import ZlibStream
+from marker import DECODERS, Marker, MarkerMatcher
+from scheduler import FairScheduler, ImmediateClock
+from process import SERVER, XMPPConnection, as_batch, batch_hook
+
+
+CORPUS = os.path.join(os.path.dirname(__file__), 'tests', 'test.xml')
+
+IDENTITY_HOOKS = '''
+def client_hook(state, stanza):
+    return stanza
+
+
+def server_hook(state, stanza):
+    return stanza
+'''
+
+
+def identity_hook(state, stanza):
+    return stanza
+
+
+MAM_ITEM = (
+    "<message to='juliet@capulet.com/balcony'>"
+    "<result xmlns='urn:xmpp:mam:2' queryid='f27' id='{n}'>"
+    "<forwarded xmlns='urn:xmpp:forward:0'>"
+    "<delay xmlns='urn:xmpp:delay' stamp='2010-07-10T23:08:25Z'/>"
+    "<message xmlns='jabber:client' from='romeo@montague.lit/orchard' "
+    "to='juliet@capulet.com/balcony' type='chat' id='m{n}'>"
+    "<body>Call me but love, and I'll be new baptized {n}</body>"
+    "</message></forwarded></result></message>"
+)
+
+MARKER = re.compile(r'REPLACEME')
+
+
+def mam_page(items):
+    body = ''.join(MAM_ITEM.format(n=n) for n in range(items))
+    return f"<stream:stream xmlns='jabber:client'>{body}".encode('utf-8')
+
+
+def marker_hook(state, stanza):
+    if stanza.complete() and MARKER.search(str(stanza)):
+        state['hits'] = state.get('hits', 0) + 1
+    return stanza
+
+
+@batch_hook
+def marker_batch_hook(state, direction, stanzas):
+    # One scan over the whole chunk, only look closer if something matched.
+    if MARKER.search('\0'.join(map(str, stanzas))):
+        for stanza in stanzas:
+            marker_hook(state, stanza)
+    return stanzas
+
+
+def load_corpus(path=CORPUS):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def timeit(fun, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        fun()
+    return (time.perf_counter() - start) / rounds
+
+
+def count_stanzas(data):
+    conn = XMPPConnection()
+    return len(conn._server_stream.add(data.decode('utf-8')))
+
+
+def per_stanza_cost(server_hook, data, rounds):
+    conn = XMPPConnection(server_hook=server_hook)
+    per_chunk = timeit(lambda: conn.server_chunk(data), rounds)
+    return per_chunk / count_stanzas(data)
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option('--rounds', default=200, type=int)
+def reload(rounds):
+    """
+    Reload time, and per stanza cost of dispatching through the loader.
+    """
+    data = load_corpus() * 50
+
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, 'hooks.py')
+        with open(path, 'w') as f:
+            f.write(IDENTITY_HOOKS)
+
+        compile_time = timeit(lambda: compile_hooks(path), rounds)
+        loader = HookLoader(path)
+
+        direct = per_stanza_cost(identity_hook, data, 20)
+        loaded = per_stanza_cost(loader.server_hook, data, 20)
+        loader.install(compile_hooks(path))
+        swapped = per_stanza_cost(loader.server_hook, data, 20)
+
+    click.echo(f'compile + validate: {compile_time * 1e3:.3f}ms')
+    click.echo(f'per stanza, direct:       {direct * 1e6:.2f}us')
+    click.echo(f'per stanza, loader:       {loaded * 1e6:.2f}us')
+    click.echo(f'per stanza, after swap:   {swapped * 1e6:.2f}us')
+
+
+@cli.command()
+@click.option('--items', default=5000, type=int)
+@click.option('--rounds', default=20, type=int)
+def batch(items, rounds):
+    """
+    Per stanza against batch hooks, on a large MAM page.
+
+    Stanzas cache their text, so each hook gets freshly parsed stanzas every
+    round (cold, paying for str()), and then the same ones again (warm).
+    """
+    page = mam_page(items).decode('utf-8')
+
+    def parse():
+        return XMPPConnection()._server_stream.add(page)
+
+    for label, hook in [('per stanza', as_batch(marker_hook)),
+                        ('batch', marker_batch_hook)]:
+        cold = 0
+        for _ in range(rounds):
+            stanzas = parse()
+            start = time.perf_counter()
+            hook({}, SERVER, stanzas)
+            cold += time.perf_counter() - start
+        cold /= rounds
+        warm = timeit(lambda: hook({}, SERVER, stanzas), rounds)
+
+        click.echo(f'{label:>10}: {cold * 1e3:.2f}ms per page cold, '
+                   f'{warm * 1e3:.2f}ms warm, '
+                   f'{cold / len(stanzas) * 1e9:.0f}ns per stanza cold')
+
+
+def bench_markers(n):
+    """
+    n markers with varied first bytes, a quarter of them starting with '<'
+    like most of an XML stream does, plus REPLACEME.
+    """
+    firsts = b'{[#@!~^%$ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+    markers = []
+    for i in range(n - 1):
+        if i % 4 == 0:
+            start = b'<!--mk%03d' % i
+        else:
+            start = bytes([firsts[i % len(firsts)]]) + b'mk%03d' % i
+        markers.append(
+            Marker(f'm{i}', start, decoder='hex' if i % 2 else 'base64')
+        )
+    return markers + [Marker('replaceme', b'REPLACEME')]
+
+
+@cli.command()
+@click.option('--max-patterns', default=128, type=int)
+@click.option('--items', default=2000, type=int)
+@click.option('--rounds', default=5, type=int)
+def markers(max_patterns, items, rounds):
+    """
+    Marker matcher throughput as the number of patterns grows.
+
+    Compared against a plain alternation of every marker pattern.
+    """
+    data = mam_page(items).replace(
+        b"baptized 7<", b"baptized REPLACEMEPHg+REPLACEME<"
+    )
+
+    n = 1
+    while n <= max_patterns:
+        configured = bench_markers(n)
+        matcher = MarkerMatcher(configured)
+        alternation = re.compile(b'|'.join(
+            b'%s(%s*)%s' % (re.escape(marker.start),
+                            DECODERS[marker.decoder][0],
+                            re.escape(marker.end))
+            for marker in configured
+        ))
+
+        elapsed = timeit(lambda: list(matcher.finditer(data)), rounds)
+        naive = timeit(lambda: list(alternation.finditer(data)), rounds)
+        found = len(list(matcher.finditer(data)))
+        click.echo(f'{n:>4} patterns: {len(data) / elapsed / 1e6:8.1f}MB/s, '
+                   f'alternation {len(data) / naive / 1e6:8.1f}MB/s'
+                   f' ({found} matches)')
+        n *= 2
+
+
+SMALL_CHUNK = (
+    b"<presence from='juliet@capulet.com/balcony'>"
+    b"<show>away</show></presence>"
+)
+
+
+def simulate_sessions(quantum, heavy_items, sessions, rate, duration):
+    """
+    Small sessions each send a stanza every 1/rate seconds while an optional
+    heavy session dumps a MAM page. Returns latencies of the small chunks.
+
+    Chunks arrive on wall clock time but are only submitted between reactor
+    turns, like a real reactor that is busy in a callback.
+    """
+    clock = ImmediateClock()
+    # A quantum larger than anything submitted handles chunks in one go.
+    scheduler = FairScheduler(quantum or 1 << 62, clock=clock)
+    latencies = []
+
+    header = b"<stream:stream xmlns='jabber:client'>"
+    small = [XMPPConnection() for _ in range(sessions)]
+    for conn in small:
+        conn.server_chunk(header)
+
+    if heavy_items:
+        heavy = XMPPConnection()
+        scheduler.submit(heavy, heavy.server_chunk, mam_page(heavy_items),
+                         lambda res: None)
+
+    start = time.perf_counter()
+    next_arrival = start
+    while next_arrival - start < duration or clock.calls:
+        now = time.perf_counter()
+        while next_arrival <= now and next_arrival - start < duration:
+            for conn in small:
+                def done(res, arrived=next_arrival):
+                    latencies.append(time.perf_counter() - arrived)
+                scheduler.submit(conn, conn.server_chunk, SMALL_CHUNK, done)
+            next_arrival += 1 / rate
+        clock.turn()
+
+    return latencies
+
+
+@cli.command()
+@click.option('--quantum', default=4096, type=int)
+@click.option('--heavy-items', default=5000, type=int)
+@click.option('--sessions', default=20, type=int)
+@click.option('--rate', default=100, type=int)
+@click.option('--duration', default=2.0, type=float)
+def fairness(quantum, heavy_items, sessions, rate, duration):
+    """
+    p99 latency of small sessions, with and without a heavy neighbour.
+    """
+    for label, q, items in [('alone', quantum, 0),
+                            ('heavy, unscheduled', 0, heavy_items),
+                            ('heavy, scheduled', quantum, heavy_items)]:
+        latencies = simulate_sessions(q, items, sessions, rate, duration)
+        click.echo(f'{label:>20}: p50 {percentile(latencies, 50) * 1e3:7.2f}ms'
+                   f' p99 {percentile(latencies, 99) * 1e3:7.2f}ms')
+
+
+COMPRESS_HANDSHAKE = (
+    b"<compress xmlns='http://jabber.org/protocol/compress'>"
+    b"<method>zlib</method></compress>",
+    b"<compressed xmlns='http://jabber.org/protocol/compress'/>",
+)
+
+
+def replay(conn, chunks):
+    start = time.perf_counter()
+    out = sum(len(conn.server_chunk(chunk)) for chunk in chunks)
+    return time.perf_counter() - start, out
+
+
+@cli.command()
+@click.option('--items', default=2000, type=int)
+@click.option('--chunk-size', default=4096, type=int)
+def compression(items, chunk_size):
+    """
+    CPU cost against bytes saved for XEP-0138, replaying the corpus.
+    """
+    header = b"<stream:stream xmlns='jabber:client'>"
+    corpus = load_corpus().split(b'<stream>')[1].split(b'</stream>')[0]
+    data = mam_page(items) + corpus * 200
+    data = data[len(header):]
+
+    plain = XMPPConnection()
+    plain.server_chunk(header)
+    plain_chunks = [data[i:i + chunk_size]
+                    for i in range(0, len(data), chunk_size)]
+    plain_time, plain_out = replay(plain, plain_chunks)
+
+    compressed = XMPPConnection()
+    compressed.client_chunk(header + COMPRESS_HANDSHAKE[0])
+    compressed.server_chunk(header + COMPRESS_HANDSHAKE[1])
+    server = zlib.compressobj()
+    wire_chunks = [
+        server.compress(chunk) + server.flush(zlib.Z_SYNC_FLUSH)
+        for chunk in [header] + plain_chunks
+    ]
+    zlib_time, zlib_out = replay(compressed, wire_chunks)
+
+    # Parsing dominates both runs, so time the zlib work on its own too.
+    stream = ZlibStream()
+    start = time.perf_counter()
+    for chunk in wire_chunks:
+        stream.deflate(stream.inflate(chunk))
+    codec_time = time.perf_counter() - start
+
+    click.echo(f'plain: {plain_time * 1e3:8.1f}ms, {plain_out} bytes out')
+    click.echo(f' zlib: {zlib_time * 1e3:8.1f}ms, {zlib_out} bytes out')
+    click.echo(f'inflate + deflate alone: {codec_time * 1e3:.1f}ms, '
+               f'{codec_time / (plain_out - zlib_out) * 1e9:.1f}ns per byte '
+               f'saved, {plain_out / zlib_out:.1f}x smaller')
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,78 @@
+"""
+XEP-0138 stream compression.
+
+Only zlib is supported. Once the server acknowledges with <compressed/>, both
+directions are compressed, so the proxy inflates what it reads and deflates
+what it forwards. Output is flushed once per processed chunk, rather than per
+stanza.
+"""
+import re
+import zlib
+
+
+COMPRESS_NS = 'http://jabber.org/protocol/compress'
+
+METHOD = re.compile(r'<method>\s*([^<\s]+)\s*</method>')
+
+
+def compress_method(stanza):
+    """
+    The method asked for, if stanza is a <compress/> request.
+    """
+    if not stanza.complete():
+        return None
+
+    text = str(stanza)
+    if not text.startswith('<compress ') or COMPRESS_NS not in text:
+        return None
+
+    m = METHOD.search(text)
+    return m.group(1) if m else None
+
+
+def is_compressed(stanza):
+    text = str(stanza)
+    return stanza.complete() and text.startswith('<compressed') and \
+        COMPRESS_NS in text
+
+
+class ZlibStream:
+    """
+    Compression state for one direction of a connection.
+    """
+
+    def __init__(self, level=zlib.Z_DEFAULT_COMPRESSION):
+        self._inflate = zlib.decompressobj()
+        self._deflate = zlib.compressobj(level)
+
+    def inflate(self, data):
+        return self._inflate.decompress(data)
+
+    def deflate(self, data):
+        if not data:
+            return b''
+        return self._deflate.compress(data) + \
+            self._deflate.flush(zlib.Z_SYNC_FLUSH)
+
+
+def test_zlib_stream():
+    sender = zlib.compressobj()
+    stream = ZlibStream()
+    receiver = zlib.decompressobj()
+
+    out = b''
+    for chunk in [b'<message>', b'<body>hi</body>', b'', b'</message>']:
+        wire = sender.compress(chunk) + sender.flush(zlib.Z_SYNC_FLUSH)
+        plain = stream.inflate(wire)
+        assert plain == chunk
+        out += receiver.decompress(stream.deflate(plain))
+
+    assert out == b'<message><body>hi</body></message>'
+
+
+def test():
+    test_zlib_stream()
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,496 @@
+"""
+Stanza fuzzing through the hook pipeline.
+
+Cases are mutated from a seed corpus of captured stanzas in a pool of worker
+processes, ahead of time. The reactor only takes ready cases and splices them
+into server -> client streams, between complete stanzas.
+
+Cases only go out with data from the server, so the rate is a ceiling. An idle
+session gets next to nothing, the periodic report shows how close each active
+session gets.
+
+Every case is generated from its case id alone (plus the corpus), so the log
+only records which case id went to which session, and `python fuzz.py show`
+regenerates a case to match up crashes.
+"""
+import hashlib
+import multiprocessing
+import os
+import random
+import re
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import click
+from twisted.internet import reactor, task
+from twisted.python import log
+
+from process import SERVER, as_batch, batch_hook
+from xmlstream import XMLStanzaStream
+
+
+INTERESTING = [
+    '', '"', "'", '<', '>', '&', '&amp;', '&#0;', '&#xFFFF;', ']]>',
+    '<![CDATA[', '<!--', '%s%n%x', '\u202e', '\ud7ff', '\U0001f4a9',
+    'A' * 1024, '9' * 64, '-1', '0', 'xmlns', 'http://', 'file:///',
+    '<x/>', '<x>', '</x>',
+]
+
+ATTRIBUTE = re.compile(r'''=(["'])[^"']*\1''')
+
+BOUND_JID = re.compile(r'<bind\b[^>]*>\s*<jid>([^<]+)</jid>')
+
+
+def load_seeds(path):
+    """
+    Complete stanzas from every file in path (or the file at path).
+
+    Files can be a captured stream, or bare stanzas.
+    """
+    if os.path.isdir(path):
+        files = sorted(os.path.join(path, f) for f in os.listdir(path))
+    else:
+        files = [path]
+
+    seeds = []
+    for name in files:
+        with open(name, 'r') as f:
+            data = f.read()
+
+        stanzas = []
+        for wrapped in [data, f'<stream>{data}</stream>']:
+            stanzas = [
+                str(stanza) for stanza in XMLStanzaStream(2).add(wrapped)
+                if stanza.complete()
+            ]
+            if stanzas:
+                break
+        seeds += stanzas
+
+    return seeds
+
+
+def corpus_hash(seeds):
+    return hashlib.sha1('\0'.join(seeds).encode('utf-8')).hexdigest()
+
+
+def flip_char(rng, case, seeds):
+    if not case:
+        return case
+    idx = rng.randrange(len(case))
+    return case[:idx] + rng.choice(INTERESTING + [chr(rng.randrange(256))]) \
+        + case[idx + 1:]
+
+
+def duplicate_span(rng, case, seeds):
+    if not case:
+        return case
+    start = rng.randrange(len(case))
+    end = rng.randrange(start, len(case) + 1)
+    return case[:end] + case[start:end] * rng.randrange(1, 8) + case[end:]
+
+
+def delete_span(rng, case, seeds):
+    if not case:
+        return case
+    start = rng.randrange(len(case))
+    end = rng.randrange(start, min(len(case), start + 64) + 1)
+    return case[:start] + case[end:]
+
+
+def insert_interesting(rng, case, seeds):
+    idx = rng.randrange(len(case) + 1)
+    return case[:idx] + rng.choice(INTERESTING) + case[idx:]
+
+
+def replace_attribute(rng, case, seeds):
+    values = list(ATTRIBUTE.finditer(case))
+    if not values:
+        return insert_interesting(rng, case, seeds)
+    m = rng.choice(values)
+    quote = m.group(1)
+    return case[:m.start()] + f'={quote}{rng.choice(INTERESTING)}{quote}' + \
+        case[m.end():]
+
+
+def splice(rng, case, seeds):
+    other = rng.choice(seeds)
+    return case[:rng.randrange(len(case) + 1)] + \
+        other[rng.randrange(len(other) + 1):]
+
+
+MUTATORS = [
+    flip_char, duplicate_span, delete_span, insert_interesting,
+    replace_attribute, splice,
+]
+
+
+def generate_case(seeds, case_id):
+    rng = random.Random(case_id)
+    case = rng.choice(seeds)
+    for _ in range(rng.randrange(1, 5)):
+        case = rng.choice(MUTATORS)(rng, case, seeds)
+    return case
+
+
+_worker_seeds = None
+
+
+def _init_worker(seeds):
+    global _worker_seeds
+    _worker_seeds = seeds
+
+
+def generate_batch(first, count):
+    return [(case_id, generate_case(_worker_seeds, case_id))
+            for case_id in range(first, first + count)]
+
+
+class CasePool:
+    """
+    Keeps a buffer of ready cases topped up from a pool of workers.
+    """
+
+    def __init__(self, seeds, workers=None, batch_size=256, low_water=1024,
+                 first_case=0):
+        self._pool = ProcessPoolExecutor(
+            workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker,
+            initargs=(seeds,)
+        )
+        self._batch_size = batch_size
+        self._low_water = low_water
+        self._next_case = first_case
+        self._in_flight = 0
+        self._ready = deque()
+        self._broken = False
+        self.generated = 0
+        self.refill()
+
+    def _give_up(self):
+        """
+        A worker died, so the executor won't take any more work. Stop
+        generating rather than failing every later take().
+        """
+        if self._broken:
+            return
+        log.err(None, 'Fuzz: worker pool broke, no more cases')
+        self._broken = True
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def refill(self):
+        while not self._broken and \
+                len(self._ready) + self._in_flight * self._batch_size < \
+                self._low_water:
+            try:
+                future = self._pool.submit(
+                    generate_batch, self._next_case, self._batch_size
+                )
+            except BrokenProcessPool:
+                self._give_up()
+                return
+            future.add_done_callback(
+                lambda f: reactor.callFromThread(self._batch_done, f)
+            )
+            self._next_case += self._batch_size
+            self._in_flight += 1
+
+    def _batch_done(self, future):
+        self._in_flight -= 1
+        try:
+            batch = future.result()
+        except BrokenProcessPool:
+            self._give_up()
+            return
+        except Exception:
+            log.err(None, 'Fuzz: generating a batch failed')
+            return
+
+        self._ready.extend(batch)
+        self.generated += len(batch)
+        self.refill()
+
+    def take(self):
+        if not self._ready:
+            return None
+
+        case = self._ready.popleft()
+        if len(self._ready) < self._low_water:
+            self.refill()
+        return case
+
+    def stop(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+class FuzzLog:
+    """
+    Compact, buffered record of which case went to which session.
+
+    Injections are `time session case_id`, and sessions get `time session
+    peer address` when first seen, then `time session jid JID` once bound.
+    """
+
+    def __init__(self, path, seeds):
+        self._f = open(path, 'a', buffering=1 << 16)
+        self._f.write('# %.3f corpus %s\n' % (time.time(), corpus_hash(seeds)))
+
+    def session(self, session, key, value):
+        self._f.write('%.3f %d %s %s\n' % (time.time(), session, key, value))
+
+    def injected(self, session, case_id):
+        self._f.write('%.3f %d %d\n' % (time.time(), session, case_id))
+
+    def flush(self):
+        self._f.flush()
+
+    def close(self):
+        self._f.close()
+
+
+class FuzzInjector:
+    """
+    Wraps hooks so ready cases get spliced into server -> client streams.
+
+    Each session gets up to `rate` cases a second, placed after complete
+    stanzas from the server once the session has authenticated. Between
+    server stanzas nothing gets sent, so quiet sessions get fewer.
+    """
+
+    def __init__(self, pool, fuzz_log, rate=10.0, report_interval=10.0):
+        self._pool = pool
+        self._log = fuzz_log
+        self._rate = rate
+        self._sessions = 0
+        # Sessions that got server data since the last report.
+        self._active = set()
+        self.injected = 0
+        self._reported = (time.perf_counter(), 0, 0)
+        self._report_interval = report_interval
+        self._reporter = None
+
+    def start(self):
+        self._reporter = task.LoopingCall(self.report)
+        self._reporter.start(self._report_interval, now=False)
+
+    def stop(self):
+        if self._reporter and self._reporter.running:
+            self._reporter.stop()
+        self._pool.stop()
+        self._log.close()
+
+    def report(self):
+        now = time.perf_counter()
+        then, injected, generated = self._reported
+        elapsed = now - then
+        rate = (self.injected - injected) / elapsed
+        per_session = rate / len(self._active) if self._active else 0
+        log.msg('Fuzz: %.1f cases/sec injected, %.1f/sec per active session '
+                '(limit %.1f, paced by server traffic) over %d sessions, '
+                '%.1f cases/sec generated, %d total' % (
+                    rate, per_session, self._rate, len(self._active),
+                    (self._pool.generated - generated) / elapsed,
+                    self.injected
+                ))
+        self._reported = (now, self.injected, self._pool.generated)
+        self._active = set()
+        self._log.flush()
+
+    def _budget(self, state):
+        now = time.monotonic()
+        # Always let a whole case build up, or rates below 1 never inject.
+        cap = max(self._rate, 1)
+        budget, last = state.get('fuzz_budget', (cap, now))
+        budget = min(cap, budget + (now - last) * self._rate)
+        return budget, now
+
+    def wrap(self, hook):
+        hook = as_batch(hook)
+
+        @batch_hook
+        def wrapped(state, direction, stanzas):
+            stanzas = hook(state, direction, stanzas)
+            if direction != SERVER:
+                return stanzas
+            return self._inject(state, stanzas)
+
+        return wrapped
+
+    def _inject(self, state, stanzas):
+        if 'fuzz_session' not in state:
+            self._sessions += 1
+            state['fuzz_session'] = self._sessions
+            state['fuzz_ready'] = False
+            state['fuzz_jid'] = None
+            self._log.session(self._sessions, 'peer', state.get('peer'))
+            log.msg('Fuzz: session %d is %s' % (
+                self._sessions, state.get('peer')
+            ))
+
+        self._active.add(state['fuzz_session'])
+
+        if state['fuzz_jid'] is None:
+            for stanza in stanzas:
+                m = BOUND_JID.search(str(stanza))
+                if m:
+                    state['fuzz_jid'] = m.group(1)
+                    self._log.session(state['fuzz_session'], 'jid', m.group(1))
+
+        if not state['fuzz_ready']:
+            # Cases sent before SASL succeeds just get the session dropped.
+            state['fuzz_ready'] = any(
+                str(stanza).startswith('<success') for stanza in stanzas
+                if not isinstance(stanza, str) and stanza.complete()
+            )
+            return stanzas
+
+        budget, now = self._budget(state)
+        if budget < 1:
+            state['fuzz_budget'] = (budget, now)
+            return stanzas
+
+        res = []
+        for stanza in stanzas:
+            res.append(stanza)
+            if budget < 1 or isinstance(stanza, str) or \
+                    not stanza.complete():
+                continue
+
+            case = self._pool.take()
+            if case is None:
+                # Workers are behind, try again next chunk.
+                budget = 0
+                continue
+
+            case_id, body = case
+            res.append(body)
+            self._log.injected(state['fuzz_session'], case_id)
+            self.injected += 1
+            budget -= 1
+
+        state['fuzz_budget'] = (budget, now)
+        return res
+
+
+def test_generate_case():
+    seeds = load_seeds(os.path.join(os.path.dirname(__file__), 'tests'))
+    assert seeds
+    for seed in seeds:
+        assert seed.startswith('<') and seed.endswith('>')
+        assert not seed.startswith('<?') and not seed.startswith('</')
+    assert generate_case(seeds, 1234) == generate_case(seeds, 1234)
+
+    _init_worker(seeds)
+    batch = generate_batch(10, 5)
+    assert [case_id for case_id, _ in batch] == list(range(10, 15))
+    assert batch[2][1] == generate_case(seeds, 12)
+
+
+def test_broken_pool():
+    class Broken:
+        def submit(self, *args):
+            raise BrokenProcessPool('worker died')
+
+        def shutdown(self, **kwargs):
+            pass
+
+    pool = CasePool(['<a/>'], workers=1, low_water=0)
+    pool.stop()
+    pool._pool = Broken()
+    pool._low_water = 4
+    pool._ready.extend([(1, '<a/>'), (2, '<b/>')])
+
+    errors = []
+    log.addObserver(errors.append)
+    try:
+        assert pool.take() == (1, '<a/>')
+        assert pool.take() == (2, '<b/>')
+        assert pool.take() is None
+    finally:
+        log.removeObserver(errors.append)
+    # Logged once, not on every take().
+    assert len([e for e in errors if e.get('isError')]) == 1
+
+
+def test_injector():
+    import tempfile
+
+    from process import XMPPConnection
+
+    class Pool:
+        generated = 0
+
+        def __init__(self):
+            self.next = 0
+
+        def take(self):
+            self.next += 1
+            return self.next, f'<case n="{self.next}"/>'
+
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, 'fuzz.log')
+        fuzz_log = FuzzLog(path, ['<a/>'])
+        injector = FuzzInjector(Pool(), fuzz_log, rate=0.5)
+        conn = XMPPConnection(server_hook=injector.wrap(None), peer='1.2:3')
+
+        conn.server_chunk(
+            b"<stream:stream><success xmlns='urn:ietf:params:xml:ns:xmpp-sasl'/>"
+        )
+        out = conn.server_chunk(
+            b"<iq type='result'><bind><jid>a@b/c</jid></bind></iq>"
+        )
+        assert out.endswith(b'<case n="1"/>')
+        # The burst is spent, and 0.5/sec won't refill it straight away.
+        assert b'<case' not in conn.server_chunk(b'<iq/>')
+
+        messages = []
+        log.addObserver(messages.append)
+        try:
+            injector.report()
+        finally:
+            log.removeObserver(messages.append)
+        [report] = [' '.join(m['message']) for m in messages]
+        assert 'over 1 sessions' in report and 'limit 0.5' in report
+        assert not injector._active
+
+        fuzz_log.close()
+        with open(path) as f:
+            lines = [line.split()[1:] for line in f if line[0] != '#']
+        assert lines == [['1', 'peer', '1.2:3'], ['1', 'jid', 'a@b/c'],
+                         ['1', '1']]
+
+
+def test():
+    test_generate_case()
+    test_broken_pool()
+    test_injector()
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.argument('corpus')
+@click.argument('case_ids', nargs=-1, type=int)
+def show(corpus, case_ids):
+    """
+    Regenerate cases from the log.
+    """
+    seeds = load_seeds(corpus)
+    click.echo(f'# corpus {corpus_hash(seeds)}')
+    for case_id in case_ids:
+        click.echo(f'{case_id}: {generate_case(seeds, case_id)!r}')
+
+
+@cli.command(name='test')
+def run_tests():
+    test()
+
+
+if __name__ == "__main__":
+    cli()
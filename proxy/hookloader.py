@@ -0,0 +1,267 @@
+"""
+Load hook modules, and swap them in without restarting the proxy.
+
+The new module is compiled and validated in a worker thread, then installed
+from the reactor thread. Connections only look at the current hooks between
+chunks, so a reload never lands halfway through processing a chunk.
+"""
+import importlib.util
+import signal
+import time
+import types
+
+from twisted.internet import defer, protocol, reactor, threads
+from twisted.protocols.basic import LineReceiver
+from twisted.python import log
+
+from process import as_batch, batch_hook
+
+
+class HookLoadError(Exception):
+    pass
+
+
+class HookSet:
+    """
+    A validated pair of hooks, from one version of a hook module.
+
+    Per stanza hooks are adapted to the batch signature here, so that cost is
+    paid once per load rather than per chunk.
+    """
+
+    def __init__(self, client_hook, server_hook, origin=None):
+        for name, fun in [('client_hook', client_hook),
+                          ('server_hook', server_hook)]:
+            if not callable(fun):
+                raise HookLoadError(f'{name} is not callable')
+
+        self.client_hook = as_batch(client_hook)
+        self.server_hook = as_batch(server_hook)
+        self.origin = origin
+
+
+def compile_hooks(path):
+    """
+    Compile and execute the hook module at path, returning a HookSet.
+
+    Runs into a fresh module object, so a broken file never touches the hooks
+    that are currently installed.
+    """
+    spec = importlib.util.spec_from_file_location('hooks', path)
+    if spec is None:
+        raise HookLoadError(f'can not load hooks from {path}')
+
+    with open(path, 'r') as f:
+        source = f.read()
+
+    try:
+        code = compile(source, path, 'exec')
+        module = types.ModuleType(spec.name)
+        module.__file__ = path
+        exec(code, module.__dict__)
+    except Exception as e:
+        raise HookLoadError(f'{path}: {e}') from e
+
+    return HookSet(
+        getattr(module, 'client_hook', None),
+        getattr(module, 'server_hook', None),
+        origin=path
+    )
+
+
+class HookLoader:
+    """
+    Owns the current HookSet.
+
+    `client_hook` and `server_hook` are stable entry points to give to the
+    factories, they always dispatch to whatever hooks are installed.
+    """
+
+    def __init__(self, path, defer_to_thread=threads.deferToThread):
+        self._path = path
+        self._current = compile_hooks(path)
+        self._defer_to_thread = defer_to_thread
+        self._reloading = None
+        self._waiters = []
+
+    def current(self):
+        return self._current
+
+    @batch_hook
+    def client_hook(self, state, direction, stanzas):
+        return self._current.client_hook(state, direction, stanzas)
+
+    @batch_hook
+    def server_hook(self, state, direction, stanzas):
+        return self._current.server_hook(state, direction, stanzas)
+
+    def install(self, hook_set):
+        # Only ever called from the reactor thread, so this is atomic with
+        # respect to stanza processing.
+        self._current = hook_set
+        return hook_set
+
+    def reload(self):
+        """
+        Recompile the hooks off the reactor thread, then swap them in.
+
+        Returns a Deferred firing with the time the reload took in seconds,
+        or None if it failed. Callers during a reload share its result, but
+        each get their own Deferred.
+        """
+        waiter = defer.Deferred()
+        self._waiters.append(waiter)
+        if self._reloading is not None:
+            return waiter
+
+        start = time.perf_counter()
+
+        def done(hook_set):
+            self.install(hook_set)
+            elapsed = time.perf_counter() - start
+            log.msg('Hooks: reloaded %s in %.3fms' % (
+                self._path, elapsed * 1000
+            ))
+            return elapsed
+
+        def failed(failure):
+            log.msg('Hooks: reload failed, keeping old hooks - %s' % (
+                failure.getErrorMessage()
+            ))
+            return None
+
+        def finished(res):
+            self._reloading = None
+            waiters, self._waiters = self._waiters, []
+            for w in waiters:
+                w.callback(res)
+
+        d = self._defer_to_thread(compile_hooks, self._path)
+        self._reloading = d
+        d.addCallbacks(done, failed)
+        d.addBoth(finished)
+        return waiter
+
+    def install_signal(self, signum=signal.SIGHUP):
+        def handler(signum, frame):
+            reactor.callFromThread(self.reload)
+
+        signal.signal(signum, handler)
+
+
+class ControlProtocol(LineReceiver):
+    delimiter = b'\n'
+
+    def lineReceived(self, line):
+        command = line.strip().decode('utf-8', 'replace')
+        match command:
+            case 'reload':
+                d = self.factory.loader.reload()
+                d.addCallback(self._reloaded)
+            case _:
+                self.sendLine(b'unknown command')
+
+    def _reloaded(self, elapsed):
+        if elapsed is None:
+            self.sendLine(b'reload failed')
+        else:
+            self.sendLine(b'reloaded in %.3fms' % (elapsed * 1000))
+
+
+class ControlFactory(protocol.Factory):
+    """
+    Line based control socket, `reload` swaps in the current hooks file.
+    """
+    protocol = ControlProtocol
+
+    def __init__(self, loader):
+        self.loader = loader
+
+
+def test_compile_hooks():
+    import os
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, 'hooks.py')
+        with open(path, 'w') as f:
+            f.write('def client_hook(state, stanza):\n    return 1\n'
+                    'def server_hook(state, stanza):\n    return 2\n')
+
+        loader = HookLoader(path)
+        assert loader.client_hook({}, 'client', [None]) == [1]
+        assert loader.server_hook({}, 'server', [None]) == [2]
+
+        with open(path, 'w') as f:
+            f.write('def client_hook(state, stanza):\n    return 3\n')
+
+        try:
+            compile_hooks(path)
+            assert False
+        except HookLoadError:
+            pass
+
+        with open(path, 'w') as f:
+            f.write('client_hook = server_hook = lambda state, stanza: 4\n')
+        loader.install(compile_hooks(path))
+        assert loader.client_hook({}, 'client', [None]) == [4]
+
+
+def test_reload():
+    import os
+    import tempfile
+
+    from twisted.internet.testing import StringTransport
+
+    pending = []
+
+    def defer_to_thread(fun, *args):
+        # Run when the test says so, like a worker thread finishing.
+        d = defer.Deferred()
+        pending.append(
+            lambda: defer.maybeDeferred(fun, *args).chainDeferred(d)
+        )
+        return d
+
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, 'hooks.py')
+        with open(path, 'w') as f:
+            f.write('client_hook = server_hook = lambda state, stanza: 1\n')
+        loader = HookLoader(path, defer_to_thread=defer_to_thread)
+
+        control = ControlFactory(loader).buildProtocol(None)
+        transport = StringTransport()
+        control.makeConnection(transport)
+
+        # A broken file keeps the old hooks.
+        with open(path, 'w') as f:
+            f.write('client_hook = server_hook = lambda state, stanza:\n')
+        control.dataReceived(b'reload\n')
+        failed = []
+        loader.reload().addCallback(failed.append)
+        assert len(pending) == 1
+        pending.pop()()
+        assert failed == [None]
+        assert transport.value() == b'reload failed\n'
+        assert loader.client_hook({}, 'client', [None]) == [1]
+
+        # Everyone waiting on one reload sees its own result.
+        transport.clear()
+        with open(path, 'w') as f:
+            f.write('client_hook = server_hook = lambda state, stanza: 2\n')
+        control.dataReceived(b'reload\nreload\n')
+        assert len(pending) == 1
+        pending.pop()()
+        lines = transport.value().splitlines()
+        assert len(lines) == 2
+        assert all(line.startswith(b'reloaded in ') for line in lines)
+        assert loader.client_hook({}, 'client', [None]) == [2]
+
+
+def test():
+    test_compile_hooks()
+    test_reload()
+
+
+if __name__ == "__main__":
+    test()
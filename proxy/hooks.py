@@ -1,9 +1,16 @@
 """
 Hooks for stanzas
 """
-import base64
 from twisted.python import log
 
+from marker import Marker, MarkerMatcher
+
+
+# Add more markers here, they all get matched in a single pass.
+MARKERS = MarkerMatcher([
+    Marker('replaceme', b'REPLACEME'),
+])
+
 
 def print_list_stanzas(label, stanzas):
     print(stanzas)
@@ -11,25 +18,28 @@ def print_list_stanzas(label, stanzas):
 
 
 def decode(message):
-    body = message.split('REPLACEME')[1]
-    return base64.b64decode(body).decode('utf-8')
+    data = message.encode('utf-8')
+    return MARKERS.search(data).decode(data).decode('utf-8')
 
 
 def is_encoded_message(message):
-    return 'REPLACEME' in message
+    return MARKERS.search(message.encode('utf-8')) is not None
 
 
 def potentially_replace(stanza):
-    if is_encoded_message(str(stanza)):
-        print('DOING REPLACEMENT')
-        try:
-            res = decode(str(stanza))
-            print('>>>>', res)
-            return res
-        except Exception as e:
-            print(f'Exception: {e}')
-            return stanza
-    return stanza
+    data = str(stanza).encode('utf-8')
+    match = MARKERS.search(data)
+    if match is None:
+        return stanza
+
+    print('DOING REPLACEMENT')
+    try:
+        res = match.decode(data).decode('utf-8')
+        print('>>>>', res)
+        return res
+    except Exception as e:
+        print(f'Exception: {e}')
+        return stanza
 
 
 def client_hook(state, stanza):
@@ -1,34 +1,95 @@
 #!/usr/bin/env python
 # coding: utf-8
 
+import os
 import sys
 import click
 
 from twisted.internet import reactor, ssl
 from twisted.python import log
-from twisted.internet.endpoints import SSL4ServerEndpoint
+from twisted.internet.endpoints import SSL4ServerEndpoint, UNIXServerEndpoint
 
 from server import ProxyServerFactory
-from hooks import client_hook, server_hook
+from hookloader import ControlFactory, HookLoader
+from scheduler import FairScheduler
+from fuzz import CasePool, FuzzInjector, FuzzLog, load_seeds
+from upstream import HealthChecker, UpstreamRouter
+
+
+DEFAULT_HOOKS = os.path.join(os.path.dirname(__file__), 'hooks.py')
 
 
 @click.command()
-@click.argument('target_address')
-@click.argument('target_port', type=int)
+@click.argument('target_address', required=False)
+@click.argument('target_port', type=int, required=False)
+@click.option('--upstreams', default=None,
+              help='JSON file routing stream domains to backends, '
+                   'instead of a single target.')
+@click.option('--health-interval', default=10.0, type=float)
 @click.option('--cert', default='./certs/server.pem')
 @click.option('--listen-address', default='0.0.0.0')
 @click.option('--listen-port', default=1337, type=int)
-def main(target_address, target_port, cert, listen_address, listen_port):
+@click.option('--hooks', default=DEFAULT_HOOKS,
+              help='Hook module, reloaded on SIGHUP.')
+@click.option('--control-socket', default=None,
+              help='UNIX socket accepting a `reload` command.')
+@click.option('--quantum', default=4096, type=int,
+              help='Bytes each session may process per reactor turn, '
+                   '0 processes every chunk as it arrives.')
+@click.option('--fuzz-corpus', default=None,
+              help='Seed stanzas, enables injecting fuzz cases.')
+@click.option('--fuzz-rate', default=10.0, type=float,
+              help='Most fuzz cases per second, per session. Cases go out '
+                   'with server data, so idle sessions get fewer.')
+@click.option('--fuzz-workers', default=None, type=int)
+@click.option('--fuzz-log', default='./fuzz.log')
+def main(target_address, target_port, upstreams, health_interval, cert,
+         listen_address, listen_port, hooks, control_socket, quantum,
+         fuzz_corpus, fuzz_rate, fuzz_workers, fuzz_log):
+    if upstreams:
+        router = UpstreamRouter.from_file(upstreams)
+    elif target_address and target_port:
+        router = UpstreamRouter.single((target_address, target_port))
+    else:
+        raise click.UsageError('give a target, or --upstreams')
+
     log.startLogging(sys.stdout)
     certData = open(cert, 'r').read()
     certificate = ssl.PrivateCertificate.loadPEM(certData).options()
     endpoint = SSL4ServerEndpoint(
         reactor, listen_port, certificate, interface=listen_address
     )
+
+    loader = HookLoader(hooks)
+    loader.install_signal()
+    if control_socket:
+        UNIXServerEndpoint(reactor, control_socket).listen(
+            ControlFactory(loader)
+        )
+
+    client_hook = loader.client_hook
+    server_hook = loader.server_hook
+    if fuzz_corpus:
+        seeds = load_seeds(fuzz_corpus)
+        injector = FuzzInjector(
+            CasePool(seeds, workers=fuzz_workers),
+            FuzzLog(fuzz_log, seeds),
+            rate=fuzz_rate
+        )
+        # Cases only ever go server -> client.
+        server_hook = injector.wrap(server_hook)
+        injector.start()
+        reactor.addSystemEventTrigger('before', 'shutdown', injector.stop)
+
+    if upstreams:
+        # A lone target is never routed around, so there is nothing to check.
+        HealthChecker(router, interval=health_interval).start()
+
     factory = ProxyServerFactory(
-        (target_address, target_port),
+        router,
         client_hook=client_hook,
-        server_hook=server_hook
+        server_hook=server_hook,
+        scheduler=FairScheduler(quantum) if quantum > 0 else None
     )
     endpoint.listen(factory)
     reactor.run()
@@ -0,0 +1,216 @@
+"""
+Find marked payloads in stanzas.
+
+The start literals of every configured marker are factored into a trie, and
+compiled into one regex over bytes, so branches are only tried where the
+literals actually share a prefix. A hit is then checked against the payload
+alphabet and end literal of the markers it could be. Matches keep offsets into
+the original data, and payloads are sliced out with memoryviews.
+"""
+import base64
+import binascii
+import re
+
+
+DECODERS = {
+    'base64': (rb'[A-Za-z0-9+/=]', binascii.a2b_base64),
+    'hex': (rb'[0-9A-Fa-f]', binascii.a2b_hex),
+}
+
+
+class Marker:
+    def __init__(self, name, start, end=None, decoder='base64'):
+        if decoder not in DECODERS:
+            raise ValueError(f'unknown decoder {decoder}')
+
+        self.name = name
+        self.start = start
+        self.end = start if end is None else end
+        self.decoder = decoder
+
+    def tail(self):
+        """
+        Matches the payload and end marker, after the start marker.
+        """
+        alphabet, _ = DECODERS[self.decoder]
+        return re.compile(b'(%s*)%s' % (alphabet, re.escape(self.end)))
+
+    def decode(self, payload):
+        _, decoder = DECODERS[self.decoder]
+        return decoder(payload)
+
+
+class MarkerMatch:
+    __slots__ = ['marker', 'start', 'end', 'payload_start', 'payload_end']
+
+    def __init__(self, marker, start, end, payload_start, payload_end):
+        self.marker = marker
+        self.start = start
+        self.end = end
+        self.payload_start = payload_start
+        self.payload_end = payload_end
+
+    def payload(self, data):
+        return memoryview(data)[self.payload_start:self.payload_end]
+
+    def decode(self, data):
+        return self.marker.decode(self.payload(data))
+
+
+# sre tries top level branches one after another, once there are a few dozen
+# distinct first bytes that dominates, so check the first two bytes up front.
+PREFILTER_FIRST_BYTES = 32
+
+
+def byte_class(values):
+    return b'[' + b''.join(re.escape(bytes([b])) for b in sorted(values)) + b']'
+
+
+def trie_regex(literals):
+    """
+    Regex source matching any of literals, longest first, factored as a trie.
+    """
+    trie = {}
+    for literal in literals:
+        node = trie
+        for b in literal:
+            node = node.setdefault(b, {})
+        node[None] = {}
+
+    def emit(node):
+        branches = [
+            re.escape(bytes([b])) + emit(child)
+            for b, child in sorted(node.items(), key=lambda i: i[0] or -1)
+            if b is not None
+        ]
+        if not branches:
+            return b''
+        if len(branches) == 1 and None not in node:
+            return branches[0]
+
+        body = b'(?:' + b'|'.join(branches) + b')'
+        # Greedy, so the longest literal wins, shorter ones are checked after.
+        return body + b'?' if None in node else body
+
+    return emit(trie)
+
+
+class MarkerMatcher:
+    """
+    Combined matcher for a set of markers.
+    """
+
+    def __init__(self, markers):
+        by_start = {}
+        for marker in markers:
+            by_start.setdefault(marker.start, []).append(
+                (marker, marker.tail())
+            )
+
+        # For each start literal the regex can hit, every marker it could be,
+        # longest start first.
+        self._candidates = {
+            hit: [
+                candidate
+                for start in sorted(by_start, key=len, reverse=True)
+                if hit.startswith(start)
+                for candidate in by_start[start]
+            ]
+            for hit in by_start
+        }
+        pattern = trie_regex(by_start)
+        firsts = {start[0] for start in by_start}
+        if len(firsts) > PREFILTER_FIRST_BYTES and \
+                all(len(start) > 1 for start in by_start):
+            seconds = {start[1] for start in by_start}
+            pattern = b'(?=%s%s)%s' % (
+                byte_class(firsts), byte_class(seconds), pattern
+            )
+        self._regex = re.compile(pattern)
+
+    def search(self, data, pos=0):
+        regex = self._regex
+        candidates = self._candidates
+        while True:
+            m = regex.search(data, pos)
+            if m is None:
+                return None
+
+            start = m.start()
+            for marker, tail in candidates[m.group()]:
+                payload_start = start + len(marker.start)
+                t = tail.match(data, payload_start)
+                if t is not None:
+                    return MarkerMatch(
+                        marker, start, t.end(), payload_start, t.end(1)
+                    )
+
+            pos = start + 1
+
+    def finditer(self, data):
+        pos = 0
+        while True:
+            match = self.search(data, pos)
+            if match is None:
+                return
+            yield match
+            pos = max(match.end, match.start + 1)
+
+
+def test_marker_matcher():
+    matcher = MarkerMatcher([
+        Marker('replaceme', b'REPLACEME'),
+        Marker('hex', b'<<', b'>>', decoder='hex'),
+    ])
+
+    payload = b'<message/>'
+    data = b'<body>REPLACEME' + base64.b64encode(payload) + \
+        b'REPLACEME and <<' + binascii.b2a_hex(payload) + b'>></body>'
+
+    matches = list(matcher.finditer(data))
+    assert [m.marker.name for m in matches] == ['replaceme', 'hex']
+    assert [m.decode(data) for m in matches] == [payload, payload]
+    assert data[matches[1].start:matches[1].end].startswith(b'<<')
+    assert isinstance(matches[0].payload(data), memoryview)
+
+    assert matcher.search(b'<body>REPLACEME</body>') is None
+    assert matcher.search(b'<body>no markers</body>') is None
+
+
+def test_shared_prefixes():
+    matcher = MarkerMatcher([
+        Marker('short', b'<!--', b'-->', decoder='hex'),
+        Marker('long', b'<!--b64:', b'-->'),
+        Marker('other', b'<?', b'?>', decoder='hex'),
+    ])
+    assert re.fullmatch(trie_regex([b'ab', b'abc', b'b']), b'abc')
+
+    data = b'<!--b64:AAAA--><!--00ff--><!--b64:!!--><?00?>'
+    matches = list(matcher.finditer(data))
+    assert [m.marker.name for m in matches] == ['long', 'short', 'other']
+    assert [m.decode(data) for m in matches] == [b'\0\0\0', b'\0\xff', b'\0']
+
+
+def test_many_markers():
+    configured = [
+        Marker(f'm{i}', bytes([0x21 + i]) + b'mk%03d' % i, decoder='hex')
+        for i in range(PREFILTER_FIRST_BYTES + 8)
+    ]
+    matcher = MarkerMatcher(configured)
+    assert matcher._regex.pattern.startswith(b'(?=')
+
+    data = b''.join(
+        b'<a>' + marker.start + b'00' + marker.end for marker in configured
+    )
+    matches = list(matcher.finditer(data))
+    assert [m.marker for m in matches] == configured
+
+
+def test():
+    test_marker_matcher()
+    test_shared_prefixes()
+    test_many_markers()
+
+
+if __name__ == "__main__":
+    test()
@@ -1,42 +1,81 @@
 #!/usr/bin/env python
 # coding: utf-8
+import codecs
+
+from compression import ZlibStream, compress_method, is_compressed
 from xmlstream import XMLStanzaStream
 
 
-def apply_hook(stanzas, fun):
-    return [fun(stanza) for stanza in stanzas]
+CLIENT = 'client'
+SERVER = 'server'
 
 
-def to_network(stanza_list):
-    return ''.join(map(str, stanza_list)).encode('utf-8')
+def batch_hook(fun):
+    """
+    Mark fun as taking every stanza from a chunk at once, as
+    fun(state, direction, stanzas), returning the replacement list.
+    """
+    fun.batch = True
+    return fun
 
 
-def identity(x):
-    return x
+def is_batch_hook(fun):
+    return getattr(fun, 'batch', False)
 
 
-def filter_none(stanza_list):
-    return list(filter(lambda x: x is not None, stanza_list))
+def per_stanza(fun):
+    """
+    Adapt a fun(state, stanza) hook to the batch signature.
+    """
+    @batch_hook
+    def wrapped(state, direction, stanzas):
+        return [fun(state, stanza) for stanza in stanzas]
+
+    return wrapped
 
 
-def wrap_state(state, fun):
-    def wrapped(stanza):
-        return fun(state, stanza)
+def as_batch(fun):
+    if not fun:
+        return passthrough
+    return fun if is_batch_hook(fun) else per_stanza(fun)
 
-    return wrapped
+
+@batch_hook
+def passthrough(state, direction, stanzas):
+    return stanzas
+
+
+def to_network(stanza_list):
+    return ''.join(map(str, stanza_list)).encode('utf-8')
+
+
+def filter_none(stanza_list):
+    return list(filter(lambda x: x is not None, stanza_list))
 
 
 class XMPPConnection:
     """
     Process a connection, extract stenzas and apply hooks to them.
+
+    Hooks can either be per stanza, fun(state, stanza), or batch hooks
+    decorated with @batch_hook.
     """
 
-    def __init__(self, server_hook=identity, client_hook=identity):
+    def __init__(self, server_hook=None, client_hook=None, peer=None):
         self._client_stream = XMLStanzaStream(2)
         self._server_stream = XMLStanzaStream(2)
-        self._state = {}
-        self._client_hook = client_hook if client_hook else identity
-        self._server_hook = server_hook if server_hook else identity
+        # Chunks can end part way through a character.
+        self._client_decoder = codecs.getincrementaldecoder('utf-8')()
+        self._server_decoder = codecs.getincrementaldecoder('utf-8')()
+        # Hooks can tell sessions apart with 'peer', the original client.
+        self._state = {'peer': peer}
+        self._client_hook = as_batch(client_hook)
+        self._server_hook = as_batch(server_hook)
+
+        # XEP-0138, set up once the server acknowledges <compress/>
+        self._compress_requested = False
+        self._client_zlib = None
+        self._server_zlib = None
 
         self._bypass = False
         self._no_modification = False
@@ -45,28 +84,145 @@ class XMPPConnection:
         if self._bypass:
             return data
 
-        res = self._client_stream.add(data.decode('utf-8'))
+        text = data
+        if self._client_zlib:
+            text = self._client_zlib.inflate(text)
+
+        res = self._client_stream.add(self._client_decoder.decode(text))
 
         res = filter_none(res)
-        res = apply_hook(res, wrap_state(self._state, self._client_hook))
+        if any(compress_method(stanza) == 'zlib' for stanza in res):
+            self._compress_requested = True
+
+        res = self._client_hook(self._state, CLIENT, res)
         res = filter_none(res)
 
         if self._no_modification:
             return data
 
+        if self._client_zlib:
+            return self._client_zlib.deflate(to_network(res))
+
         return to_network(res)
 
     def server_chunk(self, data):
         if self._bypass:
             return data
 
-        res = self._server_stream.add(data.decode('utf-8'))
+        text = data
+        if self._server_zlib:
+            text = self._server_zlib.inflate(text)
+
+        res = self._server_stream.add(self._server_decoder.decode(text))
 
         res = filter_none(res)
-        res = apply_hook(res, wrap_state(self._state, self._server_hook))
+        compressed = False
+        if self._compress_requested:
+            # The next stanza from the server answers <compress/>, anything
+            # but <compressed/> (like <failure/>) means we stay uncompressed.
+            reply = next((s for s in res if s.complete()), None)
+            if reply is not None:
+                compressed = is_compressed(reply)
+                self._compress_requested = False
+
+        res = self._server_hook(self._state, SERVER, res)
         res = filter_none(res)
 
         if self._no_modification:
-            return data
-
-        return to_network(res)
+            out = data
+        elif self._server_zlib:
+            out = self._server_zlib.deflate(to_network(res))
+        else:
+            out = to_network(res)
+
+        if compressed:
+            # The <compressed/> itself still goes out uncompressed.
+            self._client_zlib = ZlibStream()
+            self._server_zlib = ZlibStream()
+
+        return out
+
+
+def test_batch_hooks():
+    data = b'<a><b>1</b><c/></a>'
+
+    seen = []
+
+    def hook(state, stanza):
+        seen.append(str(stanza))
+        return stanza
+
+    conn = XMPPConnection(server_hook=hook)
+    assert conn.server_chunk(data) == data
+    assert [s for s in seen if s] == ['<a>', '<b>1</b>', '<c/>', '</a>']
+
+    @batch_hook
+    def drop_complete(state, direction, stanzas):
+        assert direction == CLIENT
+        return [s for s in stanzas if not s.complete()]
+
+    conn = XMPPConnection(client_hook=drop_complete)
+    assert conn.client_chunk(data) == b'<a></a>'
+
+
+def test_split_characters():
+    data = '<a><b>\u00e9\u2603</b></a>'.encode('utf-8')
+    conn = XMPPConnection()
+    res = b''.join(conn.client_chunk(data[i:i + 1]) for i in range(len(data)))
+    assert res == data
+
+
+def test_compression():
+    import zlib
+
+    conn = XMPPConnection()
+    header = b"<stream:stream xmlns='jabber:client'>"
+    conn.client_chunk(header)
+    conn.server_chunk(header)
+    conn.client_chunk(
+        b"<compress xmlns='http://jabber.org/protocol/compress'>"
+        b"<method>zlib</method></compress>"
+    )
+    ack = b"<compressed xmlns='http://jabber.org/protocol/compress'/>"
+    assert conn.server_chunk(ack) == ack
+
+    client = zlib.compressobj()
+    server = zlib.decompressobj()
+    message = b"<message><body>hi</body></message>"
+    out = b''
+    for chunk in [header, message[:10], message[10:]]:
+        wire = client.compress(chunk) + client.flush(zlib.Z_SYNC_FLUSH)
+        out += server.decompress(conn.client_chunk(wire))
+    assert out == header + message
+
+
+def test_compression_failure():
+    conn = XMPPConnection()
+    header = b"<stream:stream xmlns='jabber:client'>"
+    conn.client_chunk(header)
+    conn.server_chunk(header)
+    conn.client_chunk(
+        b"<compress xmlns='http://jabber.org/protocol/compress'>"
+        b"<method>zlib</method></compress>"
+    )
+    failure = b"<failure xmlns='http://jabber.org/protocol/compress'>" \
+        b"<setup-failed/></failure>"
+    assert conn.server_chunk(failure) == failure
+
+    # A stray <compressed/> later on doesn't switch the stream over.
+    ack = b"<compressed xmlns='http://jabber.org/protocol/compress'/>"
+    message = b"<message><body>hi</body></message>"
+    assert conn.server_chunk(ack) == ack
+    assert conn.client_chunk(message) == message
+    assert conn.server_chunk(message) == message
+
+
+def test():
+    test_batch_hooks()
+    test_split_characters()
+    test_compression()
+    test_compression_failure()
+
+
+if __name__ == "__main__":
+    test()
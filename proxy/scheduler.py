@@ -0,0 +1,191 @@
+"""
+Cooperative scheduling of parse and hook work across sessions.
+
+Each session gets a byte budget (quantum) per reactor turn, and sessions are
+served in deficit round robin order. Input left over once a session runs out
+of budget is resumed on the next turn, so one session dumping a huge roster
+can not stall everyone else.
+"""
+from collections import deque
+
+from twisted.internet import reactor
+from twisted.python import failure, log
+
+
+class FairScheduler:
+    def __init__(self, quantum=4096, clock=None):
+        self._quantum = quantum
+        self._clock = clock if clock else reactor
+        # session -> deque of [fun, data, callback, offset, errback]
+        self._queues = {}
+        self._deficit = {}
+        self._active = deque()
+        self._pending = None
+
+    def submit(self, session, fun, data, callback, errback=None):
+        """
+        Queue callback(fun(data)) for session.
+
+        data may be split into several calls to fun, callbacks for a session
+        always run in the order the data was submitted. If either raises, the
+        rest of the sessions work is dropped and errback gets the Failure, as
+        the stream has a hole in it from then on.
+        """
+        queue = self._queues.get(session)
+        if queue is None:
+            queue = self._queues[session] = deque()
+            self._deficit[session] = 0
+            self._active.append(session)
+
+        queue.append([fun, data, callback, 0, errback])
+        self._schedule()
+
+    def call_after(self, session, callback):
+        """
+        Call callback() once everything already submitted for session is done.
+        """
+        self.submit(session, None, b'', callback)
+
+    def discard(self, session):
+        if self._queues.pop(session, None) is None:
+            return
+
+        del self._deficit[session]
+        if session in self._active:
+            self._active.remove(session)
+
+    def pending(self, session):
+        queue = self._queues.get(session, ())
+        return sum(len(item[1]) - item[3] for item in queue)
+
+    def _schedule(self):
+        if self._pending is None and self._active:
+            self._pending = self._clock.callLater(0, self._run)
+
+    def _run(self):
+        self._pending = None
+        for _ in range(len(self._active)):
+            # Callbacks can discard other sessions while we go round.
+            if not self._active:
+                break
+            session = self._active.popleft()
+            if self._serve(session):
+                self._active.append(session)
+        self._schedule()
+
+    def _serve(self, session):
+        """
+        Spend this turns budget on session, return True if it has work left.
+        """
+        queue = self._queues[session]
+        deficit = self._deficit[session] + self._quantum
+
+        while queue and deficit > 0:
+            item = queue[0]
+            fun, data, callback, offset, errback = item
+
+            if fun is None:
+                queue.popleft()
+                callback()
+            else:
+                end = min(len(data), offset + deficit)
+                if end < len(data):
+                    item[3] = end
+                else:
+                    queue.popleft()
+
+                deficit -= end - offset
+                try:
+                    callback(fun(data[offset:end]))
+                except Exception:
+                    reason = failure.Failure()
+                    self.discard(session)
+                    if errback is None:
+                        log.err(reason, 'Scheduler: dropping session')
+                    else:
+                        errback(reason)
+                    return False
+
+            if session not in self._queues:
+                return False
+
+        if queue:
+            self._deficit[session] = deficit
+            return True
+
+        self.discard(session)
+        return False
+
+
+class ImmediateClock:
+    """
+    Runs calls when turn() is called, for driving the scheduler by hand.
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    def callLater(self, delay, fun, *args):
+        self.calls.append((fun, args))
+        return fun
+
+    def turn(self):
+        calls, self.calls = self.calls, []
+        for fun, args in calls:
+            fun(*args)
+        return len(calls)
+
+
+def test_fair_scheduler():
+    clock = ImmediateClock()
+    scheduler = FairScheduler(quantum=4, clock=clock)
+
+    out = []
+    scheduler.submit('heavy', bytes, b'0123456789', out.append)
+    scheduler.submit('light', bytes, b'ab', out.append)
+    scheduler.call_after('heavy', lambda: out.append('done'))
+
+    assert scheduler.pending('heavy') == 10
+    clock.turn()
+    assert out == [b'0123', b'ab']
+    clock.turn()
+    assert out == [b'0123', b'ab', b'4567']
+    clock.turn()
+    assert out == [b'0123', b'ab', b'4567', b'89', 'done']
+    assert clock.turn() == 0
+
+    scheduler.submit('gone', bytes, b'0123456789', out.append)
+    clock.turn()
+    scheduler.discard('gone')
+    clock.turn()
+    assert out[-1] == b'0123'
+
+
+def test_fair_scheduler_errors():
+    clock = ImmediateClock()
+    scheduler = FairScheduler(quantum=1024, clock=clock)
+
+    def hook(data):
+        if b'boom' in data:
+            raise ValueError('boom')
+        return data
+
+    out = []
+    errors = []
+    for chunk in [b'<a>1</a>', b'<b>boom</b>', b'<c>2</c>']:
+        scheduler.submit('session', hook, chunk, out.append, errors.append)
+    clock.turn()
+
+    assert out == [b'<a>1</a>']
+    assert len(errors) == 1 and errors[0].check(ValueError)
+    assert scheduler.pending('session') == 0
+    assert clock.turn() == 0
+
+
+def test():
+    test_fair_scheduler()
+    test_fair_scheduler_errors()
+
+
+if __name__ == "__main__":
+    test()
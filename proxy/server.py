@@ -1,18 +1,57 @@
 #!/usr/bin/env python
 # coding: utf-8
 from twisted.internet import defer, protocol, reactor, ssl
-from twisted.python import log
+from twisted.python import failure, log
 
 from process import XMPPConnection
+from upstream import StreamHeaderSniffer, UpstreamRouter
 
 
 class ProxyClientProtocol(protocol.Protocol):
     def __init__(self, srv_queue, cli_queue, factory,
-                 server_hook=None, client_hook=None):
+                 server_hook=None, client_hook=None, scheduler=None):
         self.srv_queue = srv_queue
         self.cli_queue = cli_queue
         self.factory = factory
-        self._xmpp_connection = XMPPConnection(client_hook, server_hook)
+        self._xmpp_connection = XMPPConnection(
+            server_hook=server_hook, client_hook=client_hook, peer=factory.peer
+        )
+        self._scheduler = scheduler
+        self._aborted = False
+
+    def _process(self, fun, chunk, callback):
+        if self._aborted:
+            return
+
+        if self._scheduler is None:
+            try:
+                callback(fun(chunk))
+            except Exception:
+                self._abort(failure.Failure())
+            return
+
+        self._scheduler.submit(
+            self._xmpp_connection, fun, chunk, callback, self._abort
+        )
+
+    def _abort(self, reason):
+        """
+        Processing a chunk failed, so the parser state no longer matches
+        what either side has seen. Drop both connections.
+        """
+        log.err(reason, 'Client: processing failed, dropping connections')
+        self._aborted = True
+        self.factory.continueTrying = False
+        self.transport.abortConnection()
+        if self.factory.on_abort:
+            self.factory.on_abort()
+
+    def _after_pending(self, callback):
+        if self._scheduler is None:
+            callback()
+            return
+
+        self._scheduler.call_after(self._xmpp_connection, callback)
 
     def connectionMade(self):
         log.msg("Client: connected to peer")
@@ -24,13 +63,16 @@ class ProxyClientProtocol(protocol.Protocol):
             self.cli_queue = None
             log.msg("Client: disconnecting from peer")
             self.factory.continueTrying = False
-            self.transport.loseConnection()
+            self._after_pending(self.transport.loseConnection)
             return
 
         if self.cli_queue:
             log.msg("Client: writing %d bytes to peer" % len(chunk))
-            res = self._xmpp_connection.client_chunk(chunk)
-            self.transport.write(res)
+            self._process(
+                self._xmpp_connection.client_chunk,
+                chunk,
+                self.transport.write
+            )
             self.cli_queue.get().addCallback(self.serverDataReceived)
             return
 
@@ -38,13 +80,19 @@ class ProxyClientProtocol(protocol.Protocol):
 
     def dataReceived(self, chunk):
         log.msg("Client: %d bytes received from peer" % len(chunk))
-        res = self._xmpp_connection.server_chunk(chunk)
-        self.factory.srv_queue.put(res)
+        self._process(
+            self._xmpp_connection.server_chunk,
+            chunk,
+            self.factory.srv_queue.put
+        )
 
     def connectionLost(self, why):
         if self.cli_queue:
             self.cli_queue = None
             log.msg("Client: peer disconnected unexpectedly")
+        elif self._scheduler:
+            # The original client is gone, nothing left to forward to.
+            self._scheduler.discard(self._xmpp_connection)
 
 
 class ProxyClientFactory(protocol.ReconnectingClientFactory):
@@ -53,11 +101,16 @@ class ProxyClientFactory(protocol.ReconnectingClientFactory):
     protocol = ProxyClientProtocol
 
     def __init__(self, srv_queue, cli_queue, server_hook=None,
-                 client_hook=None):
+                 client_hook=None, scheduler=None, on_abort=None, peer=None,
+                 on_retry=None):
         self.srv_queue = srv_queue
         self.cli_queue = cli_queue
+        self.on_abort = on_abort
+        self.on_retry = on_retry
+        self.peer = peer
         self._server_hook = server_hook
         self._client_hook = client_hook
+        self._scheduler = scheduler
 
     def buildProtocol(self, addr):
         return ProxyClientProtocol(
@@ -65,37 +118,99 @@ class ProxyClientFactory(protocol.ReconnectingClientFactory):
             self.cli_queue,
             self,
             server_hook=self._server_hook,
-            client_hook=self._client_hook
+            client_hook=self._client_hook,
+            scheduler=self._scheduler
+        )
+
+    def clientConnectionFailed(self, connector, reason):
+        # Give the server side a chance to move us off a dead backend. A
+        # connection that was lost after connecting just retries as before.
+        if self.continueTrying and self.on_retry:
+            self.on_retry(connector)
+        protocol.ReconnectingClientFactory.clientConnectionFailed(
+            self, connector, reason
         )
 
 
 class ProxyServer(protocol.Protocol):
-    def __init__(self, target, server_hook=None, client_hook=None):
-        self._host = target[0]
-        self._port = target[1]
+    def __init__(self, router, server_hook=None, client_hook=None,
+                 scheduler=None):
+        self._router = router
         self._server_hook = server_hook
         self._client_hook = client_hook
+        self._scheduler = scheduler
+        self._sniffer = StreamHeaderSniffer()
+        self._backend = None
 
     def connectionMade(self):
         self.srv_queue = defer.DeferredQueue()
         self.cli_queue = defer.DeferredQueue()
         self.srv_queue.get().addCallback(self.clientDataReceived)
 
+    def _server_name(self):
+        try:
+            name = self.transport.getHandle().get_servername()
+        except AttributeError:
+            return None
+        return name.decode('ascii', 'replace') if name else None
+
+    def _pick_upstream(self, chunk):
+        """
+        The domain to route on, or None if we need to see more of the stream.
+        """
+        sni = self._server_name()
+        if self._router.has_route(sni):
+            return sni
+        return self._sniffer.add(chunk)
+
+    def _connect_upstream(self, domain):
+        pool = self._router.route(domain)
+        backend = pool.pick() if pool else None
+        if backend is None:
+            log.msg("Server: no upstream for '%s'" % domain)
+            self.transport.loseConnection()
+            return
+
+        peer = self.transport.getPeer()
+        log.msg("Server: routing '%s' to %r" % (domain, backend))
+        self._backend = backend
+        backend.active += 1
+
         factory = ProxyClientFactory(
             self.srv_queue,
             self.cli_queue,
             server_hook=self._server_hook,
-            client_hook=self._client_hook
+            client_hook=self._client_hook,
+            scheduler=self._scheduler,
+            on_abort=self.transport.abortConnection,
+            peer='%s:%s' % (peer.host, peer.port),
+            on_retry=lambda connector: self._retry_upstream(pool, connector)
         )
         certificate = ssl.CertificateOptions(verify=False)
 
         reactor.connectSSL(
-            self._host,
-            self._port,
+            backend.host,
+            backend.port,
             factory,
             contextFactory=certificate
         )
 
+    def _retry_upstream(self, pool, connector):
+        """
+        Reconnect to the best backend in the pool, rather than the same one.
+        """
+        if self._backend is None:
+            return
+
+        self._backend.healthy = False
+        self._backend.active -= 1
+        backend = pool.pick()
+        log.msg('Server: retrying with %r' % backend)
+        self._backend = backend
+        backend.active += 1
+        connector.host = backend.host
+        connector.port = backend.port
+
     def clientDataReceived(self, chunk):
         log.msg("Server: writing %d bytes to original client" % len(chunk))
         self.transport.write(chunk)
@@ -103,28 +218,180 @@ class ProxyServer(protocol.Protocol):
 
     def dataReceived(self, chunk):
         log.msg("Server: %d bytes received" % len(chunk))
+        # Queued until the upstream leg is connected.
         self.cli_queue.put(chunk)
 
+        if self._sniffer is None:
+            return
+
+        domain = self._pick_upstream(chunk)
+        if domain is not None:
+            self._sniffer = None
+            self._connect_upstream(domain)
+
     def connectionLost(self, why):
         self.cli_queue.put(False)
+        if self._backend:
+            self._backend.active -= 1
+            self._backend = None
 
 
 class ProxyServerFactory(protocol.Factory):
-    def __init__(self, target, server_hook=None, client_hook=None):
-        self._target = target
+    """
+    target is either an UpstreamRouter, or a single (host, port).
+    """
+
+    def __init__(self, target, server_hook=None, client_hook=None,
+                 scheduler=None):
+        if not isinstance(target, UpstreamRouter):
+            target = UpstreamRouter.single(target)
+        self._router = target
         self._server_hook = server_hook
         self._client_hook = client_hook
+        self._scheduler = scheduler
 
     def buildProtocol(self, addr):
         return ProxyServer(
-            self._target,
+            self._router,
             server_hook=self._server_hook,
-            client_hook=self._client_hook
+            client_hook=self._client_hook,
+            scheduler=self._scheduler
         )
 
 
+def test_hook_error_aborts():
+    from twisted.internet.testing import StringTransport
+
+    from scheduler import FairScheduler, ImmediateClock
+
+    def hook(state, stanza):
+        if 'boom' in str(stanza):
+            raise ValueError('boom')
+        return stanza
+
+    clock = ImmediateClock()
+    client = StringTransport()
+    factory = ProxyClientFactory(
+        defer.DeferredQueue(),
+        defer.DeferredQueue(),
+        client_hook=hook,
+        scheduler=FairScheduler(clock=clock),
+        on_abort=client.abortConnection
+    )
+    proto = factory.buildProtocol(None)
+    upstream = StringTransport()
+    proto.makeConnection(upstream)
+
+    for chunk in [b'<stream:stream>', b'<a>1</a><b>boom</b>', b'<c>2</c>']:
+        factory.cli_queue.put(chunk)
+    clock.turn()
+    proto.dataReceived(b'<d>3</d>')
+    clock.turn()
+
+    assert upstream.value() == b'<stream:stream>'
+    assert upstream.disconnecting and client.disconnecting
+    assert not factory.continueTrying
+
+
+def test_hook_directions():
+    from twisted.internet.testing import StringTransport
+
+    from process import CLIENT, SERVER, batch_hook
+
+    seen = []
+
+    def recorder(name):
+        @batch_hook
+        def hook(state, direction, stanzas):
+            seen.append((name, direction))
+            return stanzas
+        return hook
+
+    factory = ProxyClientFactory(
+        defer.DeferredQueue(),
+        defer.DeferredQueue(),
+        server_hook=recorder('server_hook'),
+        client_hook=recorder('client_hook')
+    )
+    proto = factory.buildProtocol(None)
+    proto.makeConnection(StringTransport())
+
+    factory.cli_queue.put(b'<stream:stream>')
+    proto.dataReceived(b'<stream:stream>')
+    assert seen == [('client_hook', CLIENT), ('server_hook', SERVER)]
+
+
+class _FakeConnector:
+    def __init__(self, host, port):
+        self.host, self.port = host, port
+
+    def connect(self):
+        pass
+
+    def stopConnecting(self):
+        pass
+
+
+def _routed_upstream():
+    """
+    A ProxyServer over backends a and b, routed but not really connected.
+    """
+    from twisted.internet import task
+    from twisted.internet.address import IPv4Address
+    from twisted.internet.testing import StringTransport
+
+    from upstream import Backend
+
+    a, b = Backend('a', 1), Backend('b', 1)
+    server = ProxyServer(UpstreamRouter({'*': [a, b]}))
+    server.makeConnection(
+        StringTransport(peerAddress=IPv4Address('TCP', '10.0.0.1', 1234))
+    )
+
+    connected = []
+    original = reactor.connectSSL
+    reactor.connectSSL = lambda host, port, factory, **kw: \
+        connected.append((host, port, factory))
+    try:
+        server.dataReceived(b"<stream:stream to='capulet.com'>")
+    finally:
+        reactor.connectSSL = original
+
+    [(host, port, factory)] = connected
+    factory.clock = task.Clock()
+    first, other = (a, b) if host == 'a' else (b, a)
+    return server, factory, _FakeConnector(host, port), first, other
+
+
+def test_retry_repicks_backend():
+    server, factory, connector, first, other = _routed_upstream()
+    factory.clientConnectionFailed(connector, None)
+
+    assert connector.host == other.host
+    assert not first.healthy
+    assert (first.active, other.active) == (0, 1)
+
+    factory.stopTrying()
+    server.connectionLost(None)
+    assert other.active == 0
+
+
+def test_retry_after_lost_keeps_backend():
+    server, factory, connector, first, other = _routed_upstream()
+    # The backend closed an established session, it isn't down.
+    factory.clientConnectionLost(connector, None)
+
+    assert connector.host == first.host
+    assert first.healthy and other.healthy
+    assert (first.active, other.active) == (1, 0)
+    factory.stopTrying()
+
+
 def test():
-    pass
+    test_hook_error_aborts()
+    test_hook_directions()
+    test_retry_repicks_backend()
+    test_retry_after_lost_keeps_backend()
 
 
 if __name__ == "__main__":
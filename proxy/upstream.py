@@ -0,0 +1,258 @@
+"""
+Pick which server a connection gets proxied to.
+
+Connections are routed on the TLS SNI, or the `to` of the clients initial
+<stream:stream>, to a pool of backends. Within a pool, the healthy backend
+with the fewest connections for its weight wins.
+
+The upstream file is JSON, mapping domains to backends, with `*` as the
+fallback:
+
+    {
+        "capulet.com": [{"host": "10.0.0.1", "port": 5223, "weight": 2},
+                        {"host": "10.0.0.2", "port": 5223}],
+        "*": [{"host": "10.0.0.3", "port": 5223}]
+    }
+"""
+import codecs
+import json
+
+from twisted.internet import protocol, reactor, task
+from twisted.internet.endpoints import TCP4ClientEndpoint
+from twisted.python import log
+
+from xmlstream import BasicXMLTokenizer, MarkupToken, MarkupType
+
+
+DEFAULT_ROUTE = '*'
+
+
+class Backend:
+    def __init__(self, host, port, weight=1):
+        if weight <= 0:
+            raise ValueError(f'weight for {host}:{port} must be positive')
+
+        self.host = host
+        self.port = port
+        self.weight = weight
+        self.active = 0
+        self.healthy = True
+
+    def load(self):
+        return self.active / self.weight
+
+    def __repr__(self):
+        return f'Backend({self.host}:{self.port}, weight={self.weight})'
+
+
+class BackendPool:
+    """
+    Weighted least connections over a set of backends.
+    """
+
+    def __init__(self, backends):
+        self.backends = backends
+        self._next = 0
+
+    def pick(self):
+        candidates = [b for b in self.backends if b.healthy]
+        if not candidates:
+            # Better to try something than to refuse everyone.
+            candidates = self.backends
+        if not candidates:
+            return None
+
+        # Rotate where ties get broken, so equal backends share the load.
+        self._next = (self._next + 1) % len(candidates)
+        rotated = candidates[self._next:] + candidates[:self._next]
+        return min(rotated, key=lambda b: b.load())
+
+
+class UpstreamRouter:
+    def __init__(self, routes):
+        self._routes = {
+            domain.lower(): BackendPool(backends)
+            for domain, backends in routes.items()
+        }
+
+    @classmethod
+    def single(cls, target):
+        return cls({DEFAULT_ROUTE: [Backend(target[0], target[1])]})
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, 'r') as f:
+            config = json.load(f)
+
+        # One Backend per address, so its connection count covers every
+        # domain routed to it.
+        shared = {}
+
+        def backend(b):
+            key = (b['host'], int(b['port']))
+            if key not in shared:
+                shared[key] = Backend(*key, weight=b.get('weight', 1))
+            return shared[key]
+
+        return cls({
+            domain: [backend(b) for b in backends]
+            for domain, backends in config.items()
+        })
+
+    def has_route(self, domain):
+        return domain is not None and domain.lower() in self._routes
+
+    def route(self, domain):
+        if self.has_route(domain):
+            return self._routes[domain.lower()]
+        return self._routes.get(DEFAULT_ROUTE)
+
+    def backends(self):
+        seen = {}
+        for pool in self._routes.values():
+            for backend in pool.backends:
+                seen[id(backend)] = backend
+        return list(seen.values())
+
+
+class StreamHeaderSniffer:
+    """
+    Find the `to` of the initial <stream:stream>, without consuming the data.
+
+    add() returns None until it knows, then the domain, or '' if there is no
+    header within `limit` bytes.
+    """
+
+    def __init__(self, limit=4096):
+        self._tokenizer = BasicXMLTokenizer()
+        self._decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        self._limit = limit
+        self._seen = 0
+
+    def add(self, chunk):
+        self._seen += len(chunk)
+        for c in self._decoder.decode(chunk):
+            for token in self._tokenizer.add_char(c):
+                if isinstance(token, MarkupToken) and \
+                        token.markup_type() == MarkupType.STREAM:
+                    return token.attribute('to') or ''
+
+        if self._seen >= self._limit:
+            return ''
+        return None
+
+
+class HealthChecker:
+    """
+    Periodically TCP connects to every backend, marking it up or down.
+    """
+
+    def __init__(self, router, interval=10.0, timeout=5):
+        self._router = router
+        self._interval = interval
+        self._timeout = timeout
+        self._loop = task.LoopingCall(self.check)
+
+    def start(self):
+        self._loop.start(self._interval)
+
+    def stop(self):
+        if self._loop.running:
+            self._loop.stop()
+
+    def check(self):
+        for backend in self._router.backends():
+            endpoint = TCP4ClientEndpoint(
+                reactor, backend.host, backend.port, timeout=self._timeout
+            )
+            d = endpoint.connect(protocol.Factory.forProtocol(protocol.Protocol))
+            d.addCallbacks(
+                self._up, self._down,
+                callbackArgs=(backend,), errbackArgs=(backend,)
+            )
+
+    def _up(self, proto, backend):
+        proto.transport.loseConnection()
+        if not backend.healthy:
+            log.msg('Upstream: %r is back up' % backend)
+        backend.healthy = True
+
+    def _down(self, failure, backend):
+        if backend.healthy:
+            log.msg('Upstream: %r is down - %s' % (
+                backend, failure.getErrorMessage()
+            ))
+        backend.healthy = False
+
+
+def test_backend_pool():
+    a = Backend('a', 1, weight=2)
+    b = Backend('b', 1)
+    pool = BackendPool([a, b])
+
+    picked = []
+    for _ in range(6):
+        backend = pool.pick()
+        backend.active += 1
+        picked.append(backend.host)
+    assert picked.count('a') == 4 and picked.count('b') == 2
+
+    b.active = 0
+    a.healthy = False
+    assert pool.pick() is b
+    b.healthy = False
+    assert pool.pick() is not None
+
+
+def test_router():
+    router = UpstreamRouter({
+        'capulet.com': [Backend('c', 1)],
+        DEFAULT_ROUTE: [Backend('d', 1)],
+    })
+    assert router.route('Capulet.com').pick().host == 'c'
+    assert router.route('montague.lit').pick().host == 'd'
+    assert router.route(None).pick().host == 'd'
+    assert len(router.backends()) == 2
+
+
+def test_router_from_file():
+    import tempfile
+
+    with tempfile.NamedTemporaryFile('w', suffix='.json') as f:
+        json.dump({
+            'capulet.com': [{'host': 'a', 'port': 1, 'weight': 2},
+                            {'host': 'b', 'port': '1'}],
+            DEFAULT_ROUTE: [{'host': 'a', 'port': 1}],
+        }, f)
+        f.flush()
+        router = UpstreamRouter.from_file(f.name)
+
+    assert len(router.backends()) == 2
+    shared = router.route(None).backends[0]
+    assert shared in router.route('capulet.com').backends
+    assert shared.weight == 2
+
+
+def test_stream_header_sniffer():
+    data = (
+        "<?xml version='1.0'?><stream:stream xmlns='jabber:client' "
+        "to='capulet.com' version='1.0'>"
+    ).encode('utf-8')
+
+    sniffer = StreamHeaderSniffer()
+    assert sniffer.add(data[:30]) is None
+    assert sniffer.add(data[30:]) == 'capulet.com'
+
+    sniffer = StreamHeaderSniffer(limit=8)
+    assert sniffer.add(b'<stream:') == ''
+
+
+def test():
+    test_backend_pool()
+    test_router()
+    test_router_from_file()
+    test_stream_header_sniffer()
+
+
+if __name__ == "__main__":
+    test()
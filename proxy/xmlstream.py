@@ -1,6 +1,7 @@
 """
 XML Stream Processing
 """
+import re
 from enum import Enum, auto
 
 from defusedxml import ElementTree as ET
@@ -50,6 +51,21 @@ class MarkupType(Enum):
     CLOSE = auto()
     SELFCONTAINED = auto()
     RESET = auto()
+    STREAM = auto()
+
+
+XML_DECLARATION = re.compile(
+    r"""<\?xml\s+version\s*=\s*(["'])1\.[0-9]+\1"""
+    r"""(\s+encoding\s*=\s*(["'])[A-Za-z][A-Za-z0-9._-]*\3)?"""
+    r"""(\s+standalone\s*=\s*(["'])(yes|no)\5)?"""
+    r"""\s*\?>\Z"""
+)
+
+TAG_NAME = re.compile(r'</?([^\s/>]+)')
+
+ATTRIBUTE = r"""\s{}\s*=\s*(["'])(.*?)\1"""
+
+STREAM_HEADER = 'stream:stream'
 
 
 class MarkupToken(Token):
@@ -118,18 +134,32 @@ class MarkupToken(Token):
         return known_type and self._body[0] == '<' and self._body[-1] == '>'
 
     def is_reset(self):
-        # hack, to deal with stream resets
-        return self._body in ["<?xml version='1.0'?>", '<?xml version="1.0"?>']
+        # An XML declaration can only start a new stream.
+        return XML_DECLARATION.match(self._body) is not None
+
+    def tag_name(self):
+        m = TAG_NAME.match(self._body)
+        return m.group(1) if m else None
+
+    def attribute(self, name):
+        m = re.search(ATTRIBUTE.format(re.escape(name)), self._body)
+        return m.group(2) if m else None
 
     def markup_type(self):
-        if self.is_open():
-            return MarkupType.OPEN
-        elif self.is_close():
+        # Same result as checking is_open() first, but without recomputing
+        # every predicate for each token.
+        if self.is_close():
             return MarkupType.CLOSE
-        elif self.is_reset():
-            return MarkupType.RESET
+        elif self.is_declaration():
+            if self.is_reset():
+                return MarkupType.RESET
+            return MarkupType.SELFCONTAINED
+        elif self.is_comment() or self.is_selfcontained():
+            return MarkupType.SELFCONTAINED
+        elif self.tag_name() == STREAM_HEADER:
+            return MarkupType.STREAM
 
-        return MarkupType.SELFCONTAINED
+        return MarkupType.OPEN
 
     def __str__(self):
         return self._body
@@ -139,9 +169,11 @@ class TokenSequence:
     def __init__(self):
         self._seq = []
         self._complete = False
+        self._str = None
 
     def add(self, token):
         self._seq.append(token)
+        self._str = None
 
     def complete(self, state=None):
         if state:
@@ -150,7 +182,10 @@ class TokenSequence:
         return self._complete
 
     def __str__(self):
-        return ''.join(map(lambda x: str(x), self._seq))
+        # Hooks and to_network both want the text, only build it once.
+        if self._str is None:
+            self._str = ''.join(map(str, self._seq))
+        return self._str
 
     def to_etree(self):
         if len(self._seq) == 0:
@@ -205,7 +240,6 @@ class StanzaExtractor:
     def __init__(self, depth):
         self._threshold = depth
         self._curr_depth = 0
-        self._all = []
         self.reset()
 
     def reset(self):
@@ -240,15 +274,18 @@ class StanzaExtractor:
                     next_depth = 0
                     depth = 1
                     reset = True
+                case MarkupType.STREAM:
+                    # Stream restarts (after SASL, compression) don't close
+                    # the old stream, and may not send a declaration.
+                    next_depth = 1
+                    depth = 1
+                    reset = True
 
         self._maybe_add_token(token, depth)
         self._curr_depth = next_depth
 
         res = self._curr_sequence
 
-        # self._all.append((depth, str(token)))
-        # print('> res ', self._all)
-
         if reset:
             self.reset()
             return res
@@ -360,6 +397,56 @@ def test_stanza_extraction():
     assert found
 
 
+def test_reset_detection():
+    TEST_RESETS = [
+        ("<?xml version='1.0'?>", True),
+        ('<?xml version="1.0"?>', True),
+        ('<?xml version="1.0" encoding="UTF-8" ?>', True),
+        ("<?xml  version = '1.0'\n encoding='utf-8' standalone='yes'?>", True),
+        ('<?xml version=1.0?>', False),
+        ('<?xml-stylesheet href="a.xsl"?>', False),
+        ('<?xml value="1.0" ?>', False),
+    ]
+
+    for tag, reset in TEST_RESETS:
+        assert to_markup_token(tag).is_reset() is reset, tag
+
+    token = to_markup_token("<stream:stream to='capulet.com' version='1.0'>")
+    assert token.markup_type() == MarkupType.STREAM
+    assert to_markup_token('</stream:stream>').markup_type() == \
+        MarkupType.CLOSE
+    assert token.attribute('to') == 'capulet.com'
+    assert token.attribute('version') == '1.0'
+    assert token.attribute('from') is None
+
+
+def test_stream_restart():
+    data = (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        "<stream:stream to='capulet.com'><stream:features/>"
+        "<success xmlns='urn:ietf:params:xml:ns:xmpp-sasl'/>"
+        "<?xml version='1.0' ?><stream:stream to='capulet.com'>"
+        "<iq id='1'><bind/></iq>"
+        "<stream:stream to='capulet.com'><iq id='2'/>"
+    )
+    stanzastream = XMLStanzaStream(depth=2)
+    complete = [
+        str(stanza) for stanza in stanzastream.add(data) if stanza.complete()
+    ]
+    assert complete == [
+        '<stream:features/>',
+        "<success xmlns='urn:ietf:params:xml:ns:xmpp-sasl'/>",
+        "<iq id='1'><bind/></iq>",
+        "<iq id='2'/>",
+    ]
+
+    # The next stream's declaration and header restart it in band.
+    complete = [
+        str(stanza) for stanza in stanzastream.add(data) if stanza.complete()
+    ]
+    assert len(complete) == 4
+
+
 def test_file_extraction():
     stanzastream = XMLStanzaStream(depth=2)
     f = open('./tests/test.xml', 'r')
@@ -376,6 +463,8 @@ def test_file_extraction():
 def test():
     test_markup_tag()
     test_stanza_extraction()
+    test_reset_detection()
+    test_stream_restart()
     test_file_extraction()
 
 